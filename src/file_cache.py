@@ -0,0 +1,91 @@
+import json
+import os
+
+try:
+    # Optional: (de)serializes large files a lot faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
+
+# Parses a JSON document given as str or bytes
+json_loads = orjson.loads if orjson is not None else json.loads  # pylint: disable=no-member
+
+
+def read_json(path):
+    """
+    Load a JSON file.
+    Raises ValueError if it can't be parsed, both json and orjson errors are ValueErrors.
+    """
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())  # pylint: disable=no-member
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    """Save data as indented JSON"""
+    # Write to a temporary file first, so an interrupted save can't truncate the file
+    tmp_file = os.fspath(path) + ".tmp"
+    if orjson is not None:
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))  # pylint: disable=no-member
+    else:
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, indent=2)
+    os.replace(tmp_file, path)
+
+
+# Fields of a cache key, as they are saved in the cache files
+KEY_FIELDS = ('path', 'size', 'mtime_ns', 'ctime_ns', 'ino')
+
+
+def cache_key(file_path, file_stat):
+    """Key of a file version, the cached results of a file are dropped once it changes"""
+    # Size and mtime alone can't tell regenerated outputs apart, they get the mtime
+    # of their source, so the change time and inode are part of the key as well
+    return (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns,
+            file_stat.st_ctime_ns, file_stat.st_ino)
+
+
+def load_cache_entries(cache_file):
+    """Yield the (key, results) pairs saved in a cache file, nothing if it is missing or broken"""
+    if not os.path.exists(cache_file):
+        return
+    try:
+        entries = read_json(cache_file)
+    except (OSError, ValueError):
+        return
+    if not isinstance(entries, list):
+        return
+    for entry in entries:
+        # Skip entries of a hand-edited or otherwise broken file instead of failing the run
+        try:
+            key = tuple(entry.pop(field) for field in KEY_FIELDS)
+            hash(key)
+        except (AttributeError, KeyError, TypeError):
+            continue
+        yield key, entry
+
+
+def save_cache_entries(cache_file, items):
+    """Save (key, results) pairs to a cache file, leaving out files that were changed or removed"""
+    entries = []
+    for key, results in items:
+        try:
+            file_stat = os.stat(key[0])
+        except OSError:
+            continue
+        if cache_key(key[0], file_stat) == key:
+            entries.append({**dict(zip(KEY_FIELDS, key)), **results})
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    write_json(cache_file, entries)
+
+
+def preserve_timestamp(source_file, target_file, source_stat=None):
+    """Copy the timestamp from source file to target file"""
+    if source_stat is None:
+        source_stat = os.stat(source_file)
+    # Nanosecond timestamps, the float pair would round off sub-second precision
+    os.utime(target_file, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
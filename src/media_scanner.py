@@ -1,27 +1,186 @@
 import os
+import json
+import random
+import shutil
+import signal
+import sys
+import argparse
 import subprocess
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from datetime import datetime
 from pathlib import Path
 from tqdm import tqdm
-from pythonjsonlogger import json
 from progress_tracker import ProgressTracker
 
+try:
+    # Optional: lets files be decoded in-process instead of spawning ffmpeg
+    import av
+    import av.logging
+except ImportError:
+    av = None
+
+# Resolve the executables once instead of searching PATH for every spawned process
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+FFPROBE = shutil.which('ffprobe') or 'ffprobe'
+
+# Seconds between progress lines in non-interactive mode
+PROGRESS_PRINT_INTERVAL = 5
+
+
+def quick_error_probe(file_path):
+    """
+    Cheaply check a media file by letting ffprobe read only its container headers.
+    Returns an error description if the file looks broken, otherwise None.
+    """
+    cmd = [
+        FFPROBE, '-v', 'error', '-show_error',
+        '-show_entries', 'stream=codec_type,codec_name:format=duration',
+        '-of', 'json', str(file_path)
+    ]
+    result = subprocess.run(cmd, capture_output=True)
+
+    # Tags and file names are printed as they are, which needn't be valid UTF-8
+    stderr = result.stderr.decode('utf-8', errors='replace').strip()
+    if stderr:
+        return stderr
+    try:
+        info = json.loads(result.stdout.decode('utf-8', errors='replace'))
+    except json.JSONDecodeError:
+        return "Could not parse ffprobe output"
+    if 'error' in info:
+        return info['error'].get('string', 'Unknown ffprobe error')
+    streams = info.get('streams')
+    if not streams:
+        return "No streams found"
+    if not any(stream.get('codec_name') for stream in streams):
+        return "No stream with a known codec found"
+    try:
+        duration = float(info.get('format', {}).get('duration', 0))
+    except ValueError:
+        duration = 0
+    if duration <= 0:
+        return "No valid duration found"
+    return None
+
+
+def ffmpeg_decode_error(file_path):
+    """
+    Decode a media file with ffmpeg.
+    Returns the first error ffmpeg reported, otherwise None.
+    """
+    cmd = [
+        FFMPEG, '-v', 'error', '-i', str(file_path),
+        '-f', 'null', '-'
+    ]
+
+    # With '-v error' every stderr line is an error, so the first one settles it
+    # and there is no point in letting ffmpeg decode the rest of a broken file
+    with subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    ) as proc:
+        error = None
+        for line in proc.stderr:
+            if line.strip():
+                error = line.strip()
+                proc.terminate()
+                break
+
+    # Only decode stderr once it is known to contain an error
+    return error.decode('utf-8', errors='replace') if error else None
+
+
+def pyav_decode_error(file_path):
+    """
+    Decode a media file in-process with PyAV, without spawning ffmpeg.
+    Returns the first error libav reported, otherwise None.
+    """
+    # Capture() only collects the messages logged by the calling thread
+    with av.logging.Capture() as logs:
+        try:
+            with av.open(str(file_path)) as container:
+                for packet in container.demux():
+                    for _ in packet.decode():
+                        pass
+                    if logs:
+                        break
+        except av.error.FFmpegError as e:
+            return str(e)
+
+    if logs:
+        _, name, message = logs[0]
+        return f"[{name}] {message.strip()}"
+    return None
+
+
+def drop_page_cache(file_path):
+    """
+    Tell the kernel that the cached pages of a scanned file won't be needed again,
+    so decoding a whole library doesn't push everything else out of the page cache.
+    Does nothing where posix_fadvise isn't available (e.g. on Windows).
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FastJsonFormatter(logging.Formatter):
+    """
+    Write each record as one JSON line with a fixed set of fields.
+    Cheaper than a generic JSON formatter, which introspects every LogRecord attribute.
+    """
+
+    def format(self, record):
+        entry = {'asctime': self.formatTime(record), 'levelname': record.levelname}
+        if isinstance(record.msg, dict):
+            entry.update(record.msg)
+        else:
+            entry['message'] = record.getMessage()
+        return json.dumps(entry)
+
 
 class MediaScanner:
-    def __init__(self, media_path, log_path, is_non_interactive):
+    def __init__(self, media_path, log_path, is_non_interactive, jobs=None,
+                 quick_scan=False, full_scan_sample=0.0, use_pyav=False):
         self.media_path = Path(media_path)
         self.log_path = Path(log_path)
         self.is_non_interactive = is_non_interactive
+        self.jobs = jobs or os.cpu_count() or 1
+        # Only fully decode files whose headers look suspicious, plus a random share of the rest
+        self.quick_scan = quick_scan
+        self.full_scan_sample = full_scan_sample
+        if use_pyav and av is None:
+            print("PyAV is not installed, scanning with ffmpeg instead.")
+        self.use_pyav = use_pyav and av is not None
+        if self.use_pyav:
+            # Only forward errors from libav, just like 'ffmpeg -v error'
+            av.logging.set_level(av.logging.ERROR)
+        # Guards the counters and the progress tracker, which are shared by the scan workers
+        self.lock = threading.Lock()
         self.progress_tracker = ProgressTracker()
         self.setup_logging()
-        self.media_extensions = {
+        self.media_extensions = frozenset({
             '.mp4', '.mkv', '.avi', '.mov', '.wmv',
             '.flv', '.m4v', '.mpg', '.mpeg', '.m2ts', '.vob'
-        }
+        })
         self.error_count = 0
         self.scanned_count = 0
         self.skipped_count = 0
+        self.last_progress_print = 0.0
 
     def setup_logging(self):
         if not os.path.exists(self.log_path):
@@ -31,76 +190,131 @@ class MediaScanner:
         self.logger.setLevel(logging.INFO)
         print(f"Starting error-logging to: {log_file}")
 
-        formatter = json.JsonFormatter('%(asctime)s %(levelname)s %(message)s')
+        formatter = FastJsonFormatter()
         file_handler = logging.FileHandler(log_file)
         file_handler.setFormatter(formatter)
         self.logger.addHandler(file_handler)
 
-    def scan_file(self, file_path):
+    def scan_file(self, file_path, file_stat=None):
         """Scan a single media file for errors using ffmpeg."""
-        cmd = [
-            'ffmpeg', '-v', 'error', '-i', str(file_path),
-            '-f', 'null', '-'
-        ]
-
         try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True
-            )
+            if self.quick_scan and quick_error_probe(file_path) is None \
+                    and random.random() >= self.full_scan_sample:
+                self.mark_result(file_path, "ok", file_stat)
+                return True
 
-            if result.stderr:
-                self.error_count += 1
+            if self.use_pyav:
+                error = pyav_decode_error(file_path)
+            else:
+                error = ffmpeg_decode_error(file_path)
+            drop_page_cache(file_path)
+
+            if error:
                 self.logger.error({
                     'file': str(file_path),
-                    'error': result.stderr.strip()
+                    'error': error
                 })
-                self.progress_tracker.mark_file_scanned(str(file_path), "error")
+                self.mark_result(file_path, "error", file_stat)
                 return False
 
-            self.progress_tracker.mark_file_scanned(str(file_path), "ok")
+            self.mark_result(file_path, "ok", file_stat)
             return True
 
         except subprocess.SubprocessError as e:
-            self.error_count += 1
             self.logger.error({
                 'file': str(file_path),
                 'error': str(e)
             })
-            self.progress_tracker.mark_file_scanned(str(file_path), "error")
+            self.mark_result(file_path, "error", file_stat)
             return False
 
+    def mark_result(self, file_path, status, file_stat=None):
+        """Record the scan result of a file, safe to call from worker threads."""
+        with self.lock:
+            self.scanned_count += 1
+            if status == "error":
+                self.error_count += 1
+            self.progress_tracker.mark_file_scanned(str(file_path), status, file_stat)
+
     def find_media_files(self):
-        """Find all media files in the given directory."""
-        for root, _, files in os.walk(self.media_path):
-            for file in files:
-                if Path(file).suffix.lower() in self.media_extensions:
-                    yield Path(root) / file
+        """Find all media files in the given directory, as path strings."""
+        # Walk with os.scandir, which reuses the directory listing for type checks.
+        # Plain strings are all the scan needs, so no Path objects are created per file.
+        media_extensions = self.media_extensions
+        pending_dirs = [str(self.media_path)]
+        while pending_dirs:
+            try:
+                with os.scandir(pending_dirs.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending_dirs.append(entry.path)
+                            continue
+                        name = entry.name
+                        dot = name.rfind('.')
+                        if dot > 0 and name[dot:].lower() in media_extensions and entry.is_file():
+                            yield entry.path
+            except OSError:
+                # Unreadable directories are skipped, just like os.walk does
+                continue
 
     def scan_directory(self):
         """Scan all media files in the directory."""
         print(f"Starting media scan in: {self.media_path}")
 
-        media_files = list(self.find_media_files())
-        print(f"Found: {len(media_files)} media files to scan.")
+        # Files are scanned while the tree is still being walked, so the total isn't known up front.
+        # The rest of the progress is saved once all workers are done.
+        with self.progress_tracker, \
+                tqdm(desc="Scanning files", unit=" files") as pbar, \
+                ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            if self.is_non_interactive:
+                print(pbar)
+            pending = set()
+            try:
+                for file_path in self.find_media_files():
+                    try:
+                        file_stat = os.stat(file_path)
+                    except OSError:
+                        file_stat = None
+                    # Files that changed since their last scan (size or mtime) are scanned again
+                    with self.lock:
+                        is_scanned = self.progress_tracker.is_file_scanned(file_path, file_stat)
+                    if is_scanned:
+                        self.skipped_count += 1
+                        self.update_progress(pbar)
+                        continue
+
+                    pending.add(executor.submit(self.scan_file, file_path, file_stat))
+                    # Only keep a few files queued per worker instead of the whole tree
+                    if len(pending) >= self.jobs * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        self.collect_results(done, pbar)
 
-        with tqdm(total=len(media_files), desc="Scanning files") as pbar:
+                self.collect_results(as_completed(pending), pbar)
+            except BaseException:
+                # Leaving the executor waits for the running scans, which can take longer
+                # than a stopping container is given, so save what is done before that
+                for future in pending:
+                    future.cancel()
+                with self.lock:
+                    self.progress_tracker.flush()
+                raise
             if self.is_non_interactive:
                 print(pbar)
-            for file_path in media_files:
-                if self.progress_tracker.is_file_scanned(str(file_path)):
-                    self.skipped_count += 1
-                    pbar.update(1)
-                    if self.is_non_interactive:
-                        print(pbar)
-                    continue
-
-                self.scan_file(file_path)
-                self.scanned_count += 1
-                pbar.update(1)
-                if self.is_non_interactive:
-                    print(pbar)
+
+    def collect_results(self, futures, pbar):
+        for future in futures:
+            future.result()
+            self.update_progress(pbar)
+
+    def update_progress(self, pbar):
+        pbar.update(1)
+        # Log output can't redraw the bar, so only print a line every few seconds
+        # instead of one per file
+        if self.is_non_interactive:
+            now = time.monotonic()
+            if now - self.last_progress_print >= PROGRESS_PRINT_INTERVAL:
+                self.last_progress_print = now
+                print(pbar)
 
     def print_summary(self):
         """Print a summary of the scan results."""
@@ -112,7 +326,30 @@ class MediaScanner:
         print(f"Error log location: {self.log_path}")
 
 
+def exit_on_sigterm(signum, _frame):
+    """
+    Exit through the normal cleanup on SIGTERM. As PID 1 of a container the scanner would
+    ignore the SIGTERM of 'docker stop' and get killed without saving its progress.
+    """
+    sys.exit(128 + signum)
+
+
 def main():
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    parser = argparse.ArgumentParser(description="Scan media files for errors using ffmpeg")
+    parser.add_argument("--jobs", type=int, default=int(os.getenv('SCAN_JOBS', '0')) or None,
+                        help="Number of files to scan in parallel (default: number of CPU cores)")
+    parser.add_argument("--quick", action="store_true", default=bool(os.getenv('QUICK_SCAN', '')),
+                        help="Only check container headers and fully decode suspicious files")
+    parser.add_argument("--full-scan-sample", type=float,
+                        default=float(os.getenv('FULL_SCAN_SAMPLE', '0')),
+                        help="Share of healthy-looking files to fully decode anyway in quick mode "
+                             "(0.0 - 1.0)")
+    parser.add_argument("--pyav", action="store_true", default=bool(os.getenv('USE_PYAV', '')),
+                        help="Decode files in-process with PyAV instead of spawning ffmpeg "
+                             "(requires the av package)")
+    args = parser.parse_args()
+
     media_path = os.getenv('MEDIA_PATH', '/media')
     log_path = os.getenv('LOG_PATH', 'logs')
     is_non_interactive = os.getenv("NON_INTERACTIVE", False)
@@ -120,7 +357,9 @@ def main():
     if is_non_interactive:
         print("Running in non-interactive mode.")
 
-    scanner = MediaScanner(media_path, log_path, is_non_interactive)
+    scanner = MediaScanner(media_path, log_path, is_non_interactive, jobs=args.jobs,
+                           quick_scan=args.quick, full_scan_sample=args.full_scan_sample,
+                           use_pyav=args.pyav)
     scanner.scan_directory()
     scanner.print_summary()
 
@@ -1,17 +1,110 @@
 ﻿import os
 import re
+import json
+import shutil
 import subprocess
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from file_cache import cache_key, load_cache_entries, preserve_timestamp, save_cache_entries
 
-def run_ffmpeg(cmd, log_file=None):
+try:
+    # Optional: lets durations be read in-process instead of spawning ffmpeg
+    import av
+except ImportError:
+    av = None
+
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+FFPROBE = shutil.which('ffprobe') or 'ffprobe'
+
+# Threads given to each encoding ffmpeg, so that several conversions can share the cores
+FFMPEG_THREADS = 4
+
+# Classifies a line of level-prefixed ffmpeg stderr in a single search
+_FFMPEG_ERROR_RE = re.compile(
+    rb'(?P<dts>non monotonically increasing dts|Invalid DTS/PTS)|\[(?:error|fatal)\]'
+)
+
+# Filter graphs longer than this are passed to ffmpeg in a script file,
+# so sequences with many files stay well below the argv size limit
+MAX_FILTER_ARG_LENGTH = 8000
+
+# Splits a filter chain like '[v0][v1]xfade=...[x1]' into its input and output labels
+_CHAIN_RE = re.compile(r'((?:\[[^\]]+\])*)[^\[]+((?:\[[^\]]+\])*)')
+_LABEL_RE = re.compile(r'\[([^\]]+)\]')
+# Labels that refer to a stream of an input file, like '0:v'
+_INPUT_LABEL_RE = re.compile(r'(\d+):[va]')
+
+# Extensions of the files that get converted to MKV
+_VIDEO_EXTS = frozenset({'.vob', '.mpeg', '.mpg'})
+# Splits a sequence file name like 'movie_2.mkv' into base name and sequence number
+_SEQ_RE = re.compile(r'(.+?)_?(\d+)\.mkv$')
+
+# Probe results per file version (see file_cache.cache_key) -> {probe name: result},
+# so files are only probed again once they change
+_probe_cache = {}
+# Keeps the probe results of earlier runs
+PROBE_CACHE_FILE = "logs/merge_cache.json"
+
+
+def _cached_probe(file_path, name, probe):
+    """Return the cached result of a probe for the current version of a file, probing on a miss"""
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return probe(file_path)
+
+    results = _probe_cache.setdefault(cache_key(file_path, file_stat), {})
+    if name not in results:
+        results[name] = probe(file_path)
+    return results[name]
+
+
+def load_probe_cache(cache_file=PROBE_CACHE_FILE):
+    """Load the probe results of earlier runs"""
+    for key, results in load_cache_entries(cache_file):
+        _probe_cache.setdefault(key, {}).update(results)
+
+
+def save_probe_cache(cache_file=PROBE_CACHE_FILE):
+    """Save the probe results of all files that still exist unchanged"""
+    save_cache_entries(cache_file, ((key, results) for key, results in _probe_cache.items()
+                                    if results))
+
+
+def run_ffmpeg(cmd, log_file=None, abort_on_error=False):
+    """
+    Run an ffmpeg command and return whether it succeeded.
+    With abort_on_error, ffmpeg is stopped at the first error line it logs,
+    which needs a level-prefixed log (-v level+info).
+    """
     try:
         if log_file:
             with open(log_file, 'w') as log:
-                result = subprocess.run(cmd, stdout=log, stderr=log)
-        else:
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return result.returncode == 0
+                result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=log)
+            return result.returncode == 0
+
+        # Consume the output while ffmpeg runs and only keep its last lines,
+        # so long encodes don't pile up their whole log in memory.
+        # The progress stats are only separated by '\r', they'd make up one endless line.
+        cmd = [cmd[0], '-nostats', *cmd[1:]]
+        with subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE) as proc:
+            last_lines = deque(maxlen=10)
+            aborted = False
+            for line in proc.stderr:
+                last_lines.append(line)
+                if abort_on_error and _FFMPEG_ERROR_RE.search(line):
+                    # The output is broken already, don't spend the rest of the encode on it
+                    proc.terminate()
+                    aborted = True
+                    break
+        if aborted or proc.returncode != 0:
+            output = b''.join(last_lines).decode('utf-8', errors='replace').rstrip()
+            print(f"ffmpeg failed:\n{output}")
+            return False
+        return True
     except Exception as e:
         print(f"Error running command: {' '.join(cmd)}\n{e}")
         return False
@@ -25,51 +118,164 @@ def has_ffmpeg_errors(file_path):
     - DTS/PTS errors
     - Audio/Video sync issues
     """
-    # First check - basic error detection
-    cmd1 = ['ffmpeg', '-v', 'error', '-i', str(file_path), '-f', 'null', '-']
-
-    # Second check - specifically for DTS/PTS errors
-    cmd2 = ['ffmpeg', '-i', str(file_path), '-c', 'copy', '-f', 'null', '-']
-
-    errors = []
+    return _cached_probe(file_path, 'has_errors', _check_ffmpeg_errors)
 
-    # Run first check
-    result1 = subprocess.run(cmd1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result1.stderr.strip():
-        errors.append(f"Basic errors: {result1.stderr.decode('utf-8').strip()}")
 
-    # Run second check
-    result2 = subprocess.run(cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stderr = result2.stderr.decode('utf-8')
-    if 'non monotonically increasing dts' in stderr or 'Invalid DTS/PTS' in stderr:
-        errors.append(f"DTS/PTS errors: {stderr.strip()}")
+def _check_ffmpeg_errors(file_path):
+    # One run reads the file once for two outputs: the stream copy keeps the original
+    # timestamps, so its muxer reports the DTS/PTS problems, while the decode surfaces
+    # the basic errors. Every line is prefixed by its log level so the two can be told apart.
+    # The decode keeps the default stream selection, subtitle and data streams can't be encoded.
+    cmd = [
+        FFMPEG, '-v', 'level+warning', '-i', str(file_path),
+        '-map', '0', '-c', 'copy', '-f', 'null', '-',
+        '-f', 'null', '-'
+    ]
 
-    if errors:
+    error = None
+
+    # Read stderr line by line and stop ffmpeg at the first problem instead of buffering all of it
+    with subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE) as proc:
+        for line in proc.stderr:
+            match = _FFMPEG_ERROR_RE.search(line)
+            if not match:
+                continue
+            kind = "DTS/PTS errors" if match.group('dts') else "Basic errors"
+            error = f"{kind}: {line.decode('utf-8', errors='replace').strip()}"
+            proc.terminate()
+            break
+
+    if error:
         print(f"File has errors ({file_path}):")
-        for error in errors:
-            print(f"  - {error}")
+        print(f"  - {error}")
         return True
     return False
 
 
 def get_video_duration(file_path):
     """Get duration of video file in seconds"""
+    return _cached_probe(file_path, 'duration', _probe_video_duration)
+
+
+def _probe_video_duration(file_path):
+    if av is not None:
+        try:
+            with av.open(str(file_path)) as container:
+                if container.duration is not None:
+                    return container.duration / av.time_base
+        except av.error.FFmpegError:
+            pass  # Let ffprobe have a go at it below
+
+    return probe_file(file_path)['duration']
+
+
+def probe_file(file_path):
+    """
+    Read the duration and the codec parameters of all streams of a video file.
+    Both come from a single ffprobe call, which only reads the container header
+    without setting up any codecs.
+    """
+    # Named after the probed entries, so results cached with fewer of them aren't reused
+    return _cached_probe(file_path, 'stream_probe', _probe_file)
+
+
+def _probe_file(file_path):
     cmd = [
-        'ffmpeg', '-i', str(file_path),
-        '-hide_banner'
+        FFPROBE, '-v', 'error',
+        '-show_entries',
+        'stream=codec_type,codec_name,profile,level,width,height,pix_fmt,r_frame_rate,time_base,'
+        'sample_rate,channels,channel_layout:format=duration',
+        '-of', 'json',
+        str(file_path)
     ]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output = result.stderr.decode()
-
-    # Look for duration in the output
-    duration_match = re.search(r"Duration: (\d{2}):(\d{2}):(\d{2})\.(\d{2})", output)
-    if duration_match:
-        hours, minutes, seconds, centiseconds = map(int, duration_match.groups())
-        return hours * 3600 + minutes * 60 + seconds + centiseconds / 100
-    return None
+    result = subprocess.run(cmd, capture_output=True)
+    try:
+        # Tags are printed as they are, which needn't be valid UTF-8
+        info = json.loads(result.stdout.decode('utf-8', errors='replace'))
+    except json.JSONDecodeError:
+        info = {}
 
+    try:
+        duration = float(info.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+    streams = info.get('streams')
+    return {
+        'duration': duration,
+        # Serialized so the parameters of different files can be compared as a whole
+        'stream_params': json.dumps(streams, sort_keys=True) if streams else None
+    }
+
+
+def _label(prefix, index):
+    """
+    Short filter graph label: a letter followed by the index in base 36,
+    which keeps graphs for long sequences compact
+    """
+    digits = ''
+    while True:
+        index, digit = divmod(index, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+        if not index:
+            return prefix + digits
 
-def create_trim_script(sequence_files, output_file, trim_duration=0.5, crossfade_duration=1.0, mode="trim"):
+
+def validate_filter_graph(filter_graph, input_count):
+    """
+    Check the labels of a filter graph before handing it to ffmpeg.
+    Returns a list of the problems found, which is empty for a valid graph.
+    """
+    problems = []
+    produced = set()
+    consumed = Counter()
+    for chain in filter_graph.split(';'):
+        match = _CHAIN_RE.fullmatch(chain)
+        if not match:
+            problems.append(f"Can't parse filter chain: {chain}")
+            continue
+        consumed.update(_LABEL_RE.findall(match.group(1)))
+        for label in _LABEL_RE.findall(match.group(2)):
+            if label in produced:
+                problems.append(f"Label produced more than once: [{label}]")
+            produced.add(label)
+
+    used_inputs = set()
+    for label, uses in consumed.items():
+        input_match = _INPUT_LABEL_RE.fullmatch(label)
+        if input_match:
+            used_inputs.add(int(input_match.group(1)))
+        elif label not in produced:
+            problems.append(f"Label used but never produced: [{label}]")
+        # Reusing a stream would need a split filter, ffmpeg refuses it otherwise
+        if uses > 1:
+            problems.append(f"Label used more than once: [{label}]")
+    for index in sorted(used_inputs - set(range(input_count))):
+        problems.append(f"Graph refers to missing input {index}")
+    for index in sorted(set(range(input_count)) - used_inputs):
+        problems.append(f"Input {index} is never used")
+    return problems
+
+
+def _check_filter_graph(filter_graph, input_count):
+    """Validate a filter graph and print its problems, returns whether it is valid"""
+    problems = validate_filter_graph(filter_graph, input_count)
+    if problems:
+        print("Invalid filter graph:")
+        for problem in problems:
+            print(f"  - {problem}")
+    return not problems
+
+
+def _reset_timestamps(count):
+    """Filter chains that reset the timestamps of each input, labelled v and a per input"""
+    return [f'[{i}:v]setpts=PTS-STARTPTS[{_label("v", i)}];'
+            f'[{i}:a]asetpts=PTS-STARTPTS[{_label("a", i)}]'
+            for i in range(count)]
+
+
+def create_trim_script(sequence_files, output_file, trim_duration=0.5, crossfade_duration=1.0,
+                       mode="trim"):
     """
     Create a complex filter script for merging videos
     mode can be either "trim" or "crossfade"
@@ -77,38 +283,87 @@ def create_trim_script(sequence_files, output_file, trim_duration=0.5, crossfade
     print(f"Creating '{mode}' script for {len(sequence_files)} files...")
 
     if mode == "crossfade":
-        filter_complex = []
-
-        for i, file in enumerate(sequence_files):
-            duration = get_video_duration(file)
+        # Only the files that fade into a next one need their duration,
+        # probe them together instead of one after another
+        with ThreadPoolExecutor() as executor:
+            durations = list(executor.map(get_video_duration, sequence_files[:-1]))
+        for file, duration in zip(sequence_files, durations):
             if duration is None:
                 print(f"Could not determine duration for {file}")
                 return None, None
 
-            # Reset timestamps for each input
-            filter_complex.extend([
-                f'[{i}:v]setpts=PTS-STARTPTS[v{i}];',
-                f'[{i}:a]asetpts=PTS-STARTPTS[a{i}];'
-            ])
-
-            # Add crossfade filters except for the first file
-            if i > 0:
-                filter_complex.extend([
-                    f'[v{i - 1}][v{i}]xfade=transition=fade:duration={crossfade_duration}:'
-                    f'offset={duration - crossfade_duration}[v{i}out];',
-                    f'[a{i - 1}][a{i}]acrossfade=d={crossfade_duration}[a{i}out];'
-                ])
-
-        return "", ''.join(filter_complex)
+        # Reset timestamps for each input
+        parts = _reset_timestamps(len(sequence_files))
+
+        # Chain the crossfades, each one fading the merged result so far into the next file.
+        # The faded results are labelled x (video) and y (audio),
+        # see merge_sequence for the last ones.
+        prev_v, prev_a = _label('v', 0), _label('a', 0)
+        offset = 0.0
+        for i, duration in enumerate(durations, start=1):
+            offset += duration - crossfade_duration
+            faded_v, faded_a = _label('x', i), _label('y', i)
+            parts.append(f'[{prev_v}][{_label("v", i)}]xfade=transition=fade:'
+                         f'duration={crossfade_duration}:offset={offset}[{faded_v}]')
+            parts.append(f'[{prev_a}][{_label("a", i)}]'
+                         f'acrossfade=d={crossfade_duration}[{faded_a}]')
+            prev_v, prev_a = faded_v, faded_a
+
+        filter_graph = ';'.join(parts)
+        if not _check_filter_graph(filter_graph, len(sequence_files)):
+            return None, None
+        return "", filter_graph
     else:
         # For trim mode, just return the path (the actual work is done in merge_sequence)
         return Path('concat_script.txt'), None
 
 
-def preserve_timestamp(source_file, target_file):
-    """Copy the timestamp from source file to target file"""
-    source_stat = os.stat(str(source_file))
-    os.utime(str(target_file), (source_stat.st_atime, source_stat.st_mtime))
+def get_stream_params(file_path):
+    """Get the codec parameters of all streams in a video file, as a string that can be compared"""
+    return probe_file(file_path)['stream_params']
+
+
+def can_stream_copy(sequence_files):
+    """
+    Check if all files have the same streams and codec parameters,
+    so they can be joined without re-encoding
+    """
+    params = {get_stream_params(file) for file in sequence_files}
+    return len(params) == 1 and None not in params
+
+
+def concat_stream_copy(sequence_files, output_file):
+    """Join files with the concat demuxer, copying all streams as they are"""
+    output_file = Path(output_file)
+    list_file = output_file.with_suffix('.concat.txt')
+    with open(list_file, 'w', encoding='utf-8') as f:
+        for file in sequence_files:
+            # Single quotes have to be escaped as '\'' in concat lists
+            escaped = str(Path(file).resolve()).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    cmd = [
+        FFMPEG, '-y',
+        '-f', 'concat', '-safe', '0',
+        '-i', str(list_file),
+        '-map', '0',
+        '-c', 'copy',
+        str(output_file)
+    ]
+    try:
+        return run_ffmpeg(cmd)
+    finally:
+        list_file.unlink()
+
+
+def filter_complex_args(filter_graph, script_file):
+    """Return the ffmpeg arguments for a filter graph, written to script_file if it is too long"""
+    if len(filter_graph) <= MAX_FILTER_ARG_LENGTH:
+        return ['-filter_complex', filter_graph]
+    with open(script_file, 'w', encoding='utf-8') as f:
+        f.write(filter_graph)
+    print(f"Passing the filter graph via script file: {script_file}")
+    return ['-filter_complex_script', str(script_file)]
 
 
 def convert_to_mkv(input_file):
@@ -123,7 +378,7 @@ def convert_to_mkv(input_file):
 
     # Advanced conversion with error correction
     cmd = [
-        'ffmpeg', '-y',
+        FFMPEG, '-y',
         '-fflags', '+genpts',  # Generate presentation timestamps
         '-i', str(input_path),
         '-c:v', 'libx264',  # Re-encode video to fix potential issues
@@ -133,6 +388,7 @@ def convert_to_mkv(input_file):
         '-b:a', '192k',
         '-max_muxing_queue_size', '9999',  # Prevent muxing errors
         '-avoid_negative_ts', 'make_zero',  # Fix negative timestamps
+        '-threads', str(FFMPEG_THREADS),
         str(output_path)
     ]
 
@@ -151,24 +407,17 @@ def convert_to_mkv(input_file):
 
 def find_sequences(folder):
     """Find sequences of video files that should be merged"""
-    folder = Path(folder)
-    files = list(folder.glob('*.mkv'))
-
     # Group files by their base name (without sequence number)
-    sequences = {}
-    pattern = re.compile(r'(.+?)_?(\d+)\.mkv$')
-
-    for file in files:
-        match = pattern.match(file.name)
-        if match:
-            base_name = match.group(1)
-            seq_num = int(match.group(2))
-            if base_name not in sequences:
-                sequences[base_name] = []
-            sequences[base_name].append((seq_num, file))
-
-    # Filter and sort sequences, checking all files in a sequence for errors
-    merge_candidates = {}
+    sequences = defaultdict(list)
+
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            match = _SEQ_RE.match(entry.name)
+            if match and entry.is_file():
+                sequences[match.group(1)].append((int(match.group(2)), Path(entry.path)))
+
+    # Filter and sort sequences, keeping only those with consecutive sequence numbers
+    consecutive = {}
     for base_name, seq_files in sequences.items():
         if len(seq_files) > 1:
             # Sort by sequence number
@@ -176,23 +425,28 @@ def find_sequences(folder):
             # Check if sequence numbers are consecutive
             nums = [x[0] for x in sorted_files]
             if nums == list(range(min(nums), max(nums) + 1)):
-                # Check all files in sequence for errors
-                files_with_errors = []
-                for _, file in sorted_files:
-                    if has_ffmpeg_errors(file):
-                        files_with_errors.append(file.name)
-
-                if files_with_errors:
-                    print(f"\nSkipping sequence '{base_name}' due to errors in files:")
-                    for error_file in files_with_errors:
-                        print(f"  - {error_file}")
-                else:
-                    merge_candidates[base_name] = [x[1] for x in sorted_files]
+                consecutive[base_name] = [x[1] for x in sorted_files]
+
+    # Check all files of all sequences for errors at once, each check runs its own ffmpeg
+    files_to_check = [file for seq_files in consecutive.values() for file in seq_files]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        has_errors = dict(zip(files_to_check, executor.map(has_ffmpeg_errors, files_to_check)))
+
+    merge_candidates = {}
+    for base_name, seq_files in consecutive.items():
+        files_with_errors = [file.name for file in seq_files if has_errors[file]]
+        if files_with_errors:
+            print(f"\nSkipping sequence '{base_name}' due to errors in files:")
+            for error_file in files_with_errors:
+                print(f"  - {error_file}")
+        else:
+            merge_candidates[base_name] = seq_files
 
     return merge_candidates
 
 
-def merge_sequence(sequence_files, output_file, mode="trim", trim_duration=0.5, crossfade_duration=1.0):
+def merge_sequence(sequence_files, output_file, mode="trim", trim_duration=0.5,
+                   crossfade_duration=1.0):
     """Merge a sequence of video files with either trimming or crossfade"""
     # First verify all input files again
     for file in sequence_files:
@@ -200,38 +454,75 @@ def merge_sequence(sequence_files, output_file, mode="trim", trim_duration=0.5,
             print(f"Aborting merge due to errors in: {file}")
             return False
 
-    if mode == "trim":
-        script_path = create_trim_script(sequence_files, output_file, trim_duration)
-        if script_path is None:
-            return False
+    output_file = Path(output_file)
+    # Only written for long filter graphs, kept after a failed merge for debugging
+    filter_file = output_file.with_suffix('.filter.txt')
+
+    if mode == "trim" and can_stream_copy(sequence_files):
+        # Identical codecs and parameters, so the files can simply be joined in seconds
+        print("All files share the same codec parameters, joining them without re-encoding...")
+        if _merge_to(sequence_files, output_file, filter_file, "copy", crossfade_duration):
+            return True
+        # Not every parameter that matters is compared, the filter graph always works
+        print("Joining without re-encoding failed, re-encoding instead...")
+
+    return _merge_to(sequence_files, output_file, filter_file, mode, crossfade_duration)
+
+
+def _merge_to(sequence_files, output_file, filter_file, mode, crossfade_duration):
+    """Merge with one mode and check the output, which is deleted if anything fails"""
+    try:
+        success = _encode_sequence(sequence_files, output_file, filter_file, mode,
+                                   crossfade_duration)
+    except BaseException:
+        # A merge cut short leaves a truncated but readable MKV behind,
+        # which the next run would skip as already merged
+        output_file.unlink(missing_ok=True)
+        raise
+
+    if not success:
+        output_file.unlink(missing_ok=True)
+        return False
+    filter_file.unlink(missing_ok=True)
+
+    # Check the output file for errors regardless of merge mode
+    if has_ffmpeg_errors(output_file):
+        print("Merged file has errors - deleting output")
+        output_file.unlink()
+        return False
+
+    return True
+
+
+def _encode_sequence(sequence_files, output_file, filter_file, mode, crossfade_duration):
+    """Run the ffmpeg job for one merge mode, returns whether it succeeded"""
+    if mode == "copy":
+        return concat_stream_copy(sequence_files, output_file)
+
+    # Both re-encoding modes feed every file as a separate input
+    input_args = []
+    for f in sequence_files:
+        input_args.extend(['-i', os.fspath(f)])
 
+    if mode == "trim":
         # Create a complex filter for concatenation instead of using concat demuxer
-        filter_complex = []
-        for i, _ in enumerate(sequence_files):
-            # Add input setpts filters to reset timestamps for each input
-            filter_complex.extend([
-                f'[{i}:v]setpts=PTS-STARTPTS[v{i}];',
-                f'[{i}:a]asetpts=PTS-STARTPTS[a{i}];'
-            ])
-
-        # Concatenate all streams
-        v_streams = ''.join(f'[v{i}]' for i in range(len(sequence_files)))
-        a_streams = ''.join(f'[a{i}]' for i in range(len(sequence_files)))
-        filter_complex.extend([
-            f'{v_streams}concat=n={len(sequence_files)}:v=1:a=0[vout];',
-            f'{a_streams}concat=n={len(sequence_files)}:v=0:a=1[aout]'
-        ])
-
-        input_args = []
-        for f in sequence_files:
-            input_args.extend(['-i', str(f)])
+        count = len(sequence_files)
+        # Reset timestamps for each input
+        parts = _reset_timestamps(count)
+        # Concatenate video and audio together in one filter, which takes the segments pairwise
+        segments = ''.join(f'[{_label("v", i)}][{_label("a", i)}]' for i in range(count))
+        parts.append(f'{segments}concat=n={count}:v=1:a=1[x][y]')
+        filter_graph = ';'.join(parts)
+        if not _check_filter_graph(filter_graph, count):
+            return False
 
         cmd = [
-            'ffmpeg', '-y',
+            FFMPEG, '-y',
+            '-v', 'level+info',  # Lets run_ffmpeg spot errors while encoding
             *input_args,
-            '-filter_complex', ''.join(filter_complex),
-            '-map', '[vout]',
-            '-map', '[aout]',
+            *filter_complex_args(filter_graph, filter_file),
+            '-map', '[x]',
+            '-map', '[y]',
             '-c:v', 'libx264',
             '-preset', 'medium',
             '-crf', '23',
@@ -239,11 +530,11 @@ def merge_sequence(sequence_files, output_file, mode="trim", trim_duration=0.5,
             '-b:a', '192k',
             '-max_muxing_queue_size', '9999',
             '-avoid_negative_ts', 'make_zero',
+            '-threads', str(FFMPEG_THREADS),
             str(output_file)
         ]
 
-        success = run_ffmpeg(cmd)
-        script_path.unlink()  # Remove temporary script file
+        success = run_ffmpeg(cmd, abort_on_error=True)
 
     elif mode == "crossfade":
         inputs, filter_script = create_trim_script(
@@ -257,56 +548,78 @@ def merge_sequence(sequence_files, output_file, mode="trim", trim_duration=0.5,
             return False
 
         # Similar approach for crossfade mode
-        input_args = []
-        for f in sequence_files:
-            input_args.extend(['-i', str(f)])
-
         cmd = [
-            'ffmpeg', '-y',
+            FFMPEG, '-y',
+            '-v', 'level+info',  # Lets run_ffmpeg spot errors while encoding
             *input_args,
-            '-filter_complex', filter_script,
-            '-map', f'[v{len(sequence_files) - 1}out]',
-            '-map', f'[a{len(sequence_files) - 1}out]',
+            *filter_complex_args(filter_script, filter_file),
+            '-map', f'[{_label("x", len(sequence_files) - 1)}]',
+            '-map', f'[{_label("y", len(sequence_files) - 1)}]',
             '-c:v', 'libx264',
-            '-preset', 'medium',
+            # The filter graph has to decode everything anyway, so trade a little size for speed
+            '-preset', 'faster',
             '-crf', '23',
             '-c:a', 'aac',
             '-b:a', '192k',
             '-max_muxing_queue_size', '9999',
             '-avoid_negative_ts', 'make_zero',
+            '-threads', str(FFMPEG_THREADS),
             str(output_file)
         ]
 
-        success = run_ffmpeg(cmd)
+        success = run_ffmpeg(cmd, abort_on_error=True)
 
     else:
         print(f"Unknown merge mode: {mode}")
         return False
 
-    # Check the output file for errors regardless of merge mode
-    if success and has_ffmpeg_errors(output_file):
-        print("Merged file has errors - deleting output")
-        output_file.unlink()
-        return False
-
     return success
 
 
-def process_folder(root_dir):
+def merge_and_verify(sequence_files, output_file, **merge_options):
+    """Merge a sequence, verify the result and give it the timestamp of the first file"""
+    print(f"Merging to: {output_file}")
+    # merge_sequence already deletes outputs that fail the error check
+    if merge_sequence(sequence_files, output_file, **merge_options):
+        preserve_timestamp(sequence_files[0], output_file)
+        return True
+    return False
+
+
+def process_folder(root_dir, jobs=None, force=False):
     root_dir = Path(root_dir)
 
-    # First, convert all VOB and MPEG files to MKV
-    for ext in ['*.vob', '*.VOB', '*.mpeg', '*.MPEG', '*.mpg', '*.MPG']:
-        for video_file in root_dir.rglob(ext):
-            if not convert_to_mkv(video_file):
+    # First, convert all VOB and MPEG files to MKV, found in a single walk over the tree.
+    # Files sharing an output name (e.g. 'a.vob' and 'a.mpg') are only converted once,
+    # so that no two conversions write to the same MKV at the same time.
+    to_convert = {}
+    for dir_path, _, file_names in os.walk(root_dir):
+        for file_name in file_names:
+            if os.path.splitext(file_name)[1].lower() in _VIDEO_EXTS:
+                video_file = Path(dir_path) / file_name
+                to_convert.setdefault(video_file.with_suffix('.mkv'), video_file)
+
+    # ffmpeg runs in a subprocess, so threads are enough to run several conversions at once
+    jobs = jobs or max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)
+    video_files = list(to_convert.values())
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for video_file, mkv_file in zip(video_files, executor.map(convert_to_mkv, video_files)):
+            if not mkv_file:
                 print("Failed to convert to MKV: " + video_file.name)
 
-    # Then find and merge sequences
+    # Then find and merge sequences, asking for all of them before starting any merge
     sequences = find_sequences(root_dir)
+    merge_jobs = []
 
     if sequences:
         print("\nFound the following sequences that could be merged:")
         for base_name, files in sequences.items():
+            output_file = root_dir / f"{base_name}_merged.mkv"
+            # An intact merge from an earlier run is a lot cheaper to check than to encode again
+            if not force and output_file.exists() and not has_ffmpeg_errors(output_file):
+                print(f"\nSkipping sequence '{base_name}' - already merged to: {output_file}")
+                continue
+
             print(f"\nSequence '{base_name}':")
             for f in files:
                 print(f"  {f.name}")
@@ -318,33 +631,46 @@ def process_folder(root_dir):
                 print("Please enter 'n', 'trim', or 'crossfade'")
 
             if merge != 'n':
-                output_file = root_dir / f"{base_name}_merged.mkv"
-                print(f"Merging to: {output_file}")
-
                 if merge == 'trim':
-                    trim_duration = float(input("Enter trim duration in seconds (default 0.5): ") or 0.5)
-                    if merge_sequence(files, output_file, mode="trim",
-                                      trim_duration=trim_duration) and not has_ffmpeg_errors(output_file):
-                        preserve_timestamp(files[0], output_file)
-                        print("Merge successful!")
-                    else:
-                        print("Merge failed!")
+                    trim_duration = float(
+                        input("Enter trim duration in seconds (default 0.5): ") or 0.5)
+                    options = {'mode': 'trim', 'trim_duration': trim_duration}
                 else:  # crossfade
-                    crossfade_duration = float(input("Enter crossfade duration in seconds (default 1.0): ") or 1.0)
-                    if merge_sequence(files, output_file, mode="crossfade",
-                                      crossfade_duration=crossfade_duration) and not has_ffmpeg_errors(output_file):
-                        preserve_timestamp(files[0], output_file)
-                        print("Merge successful!")
-                    else:
-                        print("Merge failed!")
+                    crossfade_duration = float(
+                        input("Enter crossfade duration in seconds (default 1.0): ") or 1.0)
+                    options = {'mode': 'crossfade', 'crossfade_duration': crossfade_duration}
+                merge_jobs.append((files, output_file, options))
     else:
         print("\nNo sequences found that need to be merged.")
 
+    # Sequences are independent of each other, so several of them can be merged at once
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(merge_and_verify, files, output_file, **options): output_file
+            for files, output_file, options in merge_jobs
+        }
+        for future in as_completed(futures):
+            if future.result():
+                print(f"Merge successful: {futures[future]}")
+            else:
+                print(f"Merge failed: {futures[future]}")
+
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Convert videos to MKV and merge sequences")
     parser.add_argument("input_folder", help="Root folder to scan for video files")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of conversions and merges to run in parallel "
+                             f"(default: CPU cores / {FFMPEG_THREADS})")
+    parser.add_argument("--force", action="store_true",
+                        help="Merge sequences again even if an intact merged file already exists")
     args = parser.parse_args()
-    process_folder(args.input_folder)
+
+    # Files that haven't changed since an earlier run are not probed again
+    load_probe_cache()
+    try:
+        process_folder(args.input_folder, jobs=args.jobs, force=args.force)
+    finally:
+        save_probe_cache()
@@ -1,54 +1,108 @@
-﻿import json
-from pathlib import Path
-from collections import defaultdict
+﻿import os
+import sys
+
+from file_cache import json_loads, read_json
+from progress_tracker import errors_file_for
+
+
+def _add_error(tree, filepath, last_scan):
+    """Add a failed file to the tree, sorted in by its main folder and subfolder"""
+    # The scanned paths are POSIX paths, so splitting the string is enough
+    # and much cheaper than building a Path for every entry
+    parts = filepath.split('/')
+    if len(parts) >= 3:  # Ensure we have enough parts
+        main_folder = parts[1]  # Skip the leading slash
+        sub_folder = parts[2]
+        filename = parts[-1]
+
+        # Add to our tree structure, as a (filename, last scan) pair
+        # which is cheaper than a dict per entry and sorts by filename
+        tree.setdefault(main_folder, {}).setdefault(sub_folder, []).append((filename, last_scan))
 
 
 def parse_and_filter_errors(json_data):
-    # Create a nested default-dict to store the tree structure
-    tree = defaultdict(lambda: defaultdict(list))
+    # Nested plain dicts store the tree structure: main folder -> subfolder -> files
+    tree = {}
 
     # Parse the JSON if it's a string, otherwise use the dict directly
     if isinstance(json_data, str):
-        data = json.loads(json_data)
+        data = json_loads(json_data)
     else:
         data = json_data
 
     # Filter and organize errors
     for filepath, info in data.items():
         if info['status'] == 'error':
-            # Convert the path to a Path object for easier manipulation
-            path = Path(filepath)
-
-            # Get the main folder (first level) and subfolder (second level)
-            parts = path.parts
-            if len(parts) >= 3:  # Ensure we have enough parts
-                main_folder = parts[1]  # Skip the leading slash
-                sub_folder = parts[2]
-                filename = path.name
-
-                # Add to our tree structure
-                tree[main_folder][sub_folder].append({
-                    'filename': filename,
-                    'last_scan': info['last_scan']
-                })
+            _add_error(tree, filepath, info['last_scan'])
+
+    return tree
+
+
+def _asctime_to_iso(asctime):
+    """Turn a logging asctime like '2024-01-31 12:00:00,123' into the ISO format of last_scan"""
+    return asctime.replace(' ', 'T', 1).replace(',', '.', 1)
+
+
+def parse_and_filter_errors_from_log(log_file):
+    """Build the same tree from a scan_errors_*.log file, which has one JSON record per line"""
+    tree = {}
+
+    # Lines are read as bytes, both parsers take them without decoding first
+    with open(log_file, 'rb') as f:
+        for line in f:
+            # A plain substring search skips non-error records before any JSON is parsed
+            if b'"ERROR"' not in line:
+                continue
+            try:
+                record = json_loads(line)
+            except ValueError:
+                continue  # E.g. a line cut off by an interrupted scan
+            if record.get('levelname') == 'ERROR' and 'file' in record:
+                _add_error(tree, record['file'], _asctime_to_iso(record['asctime']))
 
     return tree
 
 
+def load_scan_results(progress_file):
+    """
+    Load the scan results of a progress file.
+    If the scanner saved its failed files on their own, only those are read.
+    """
+    errors_file = errors_file_for(progress_file)
+    if os.path.exists(errors_file) and (
+            not os.path.exists(progress_file)
+            or os.path.getmtime(errors_file) >= os.path.getmtime(progress_file)):
+        progress_file = errors_file
+    return read_json(progress_file)
+
+
 def print_error_tree(tree):
+    # Collect the whole report first and write it at once,
+    # instead of one print call per line for large trees
+    lines = []
     for main_folder, subfolders in sorted(tree.items()):
-        print(f"/{main_folder}/")
+        lines.append(f"/{main_folder}/")
         for subfolder, files in sorted(subfolders.items()):
-            print(f"  /{subfolder}/")
-            for file in sorted(files, key=lambda x: x['filename']):
-                print(f"    - {file['filename']}")
-                # print(f"      Last scan: {file['last_scan']}")
+            lines.append(f"  /{subfolder}/")
+            for filename, _last_scan in sorted(files):
+                lines.append(f"    - {filename}")
+                # lines.append(f"      Last scan: {_last_scan}")
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 
 if __name__ == "__main__":
-    with open('C:/Users/dome/Downloads/progress.json', 'r') as f:
-        data = json.load(f)
-        error_tree = parse_and_filter_errors(data)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print the files that failed a scan as a tree")
+    parser.add_argument("scan_file", nargs="?", default='C:/Users/dome/Downloads/progress.json',
+                        help="Progress file of the scanner, or one of its scan_errors_*.log files")
+    args = parser.parse_args()
+
+    if args.scan_file.endswith('.log'):
+        error_tree = parse_and_filter_errors_from_log(args.scan_file)
+    else:
+        error_tree = parse_and_filter_errors(load_scan_results(args.scan_file))
 
     # Print the results
     print_error_tree(error_tree)
@@ -1,33 +1,91 @@
-import json
+import atexit
 import os
+import time
 from datetime import datetime
 
+from file_cache import read_json, write_json
+
+# Seconds after which changes are saved, even if fewer than flush_every files were scanned
+FLUSH_INTERVAL = 60
+
+
+def errors_file_for(progress_file):
+    """Path of the file that holds only the failed entries of a progress file"""
+    return os.path.join(os.path.dirname(progress_file), "errors.json")
+
 
 class ProgressTracker:
-    def __init__(self, progress_file="logs/progress.json"):
+    def __init__(self, progress_file="logs/progress.json", flush_every=500):
         self.progress_file = progress_file
         self.scanned_files = self._load_progress()
+        # The failed files are also saved on their own, so error reports don't have to
+        # read through every scanned file of the library
+        self.errors_file = errors_file_for(progress_file)
+        self.failed_files = {path: entry for path, entry in self.scanned_files.items()
+                             if entry.get("status") == "error"}
+        # Rewriting the whole file for every scanned file gets slow on large libraries,
+        # so changes are only written out every flush_every files
+        # or every FLUSH_INTERVAL when files take long to scan
+        self.flush_every = flush_every
+        self._dirty = 0
+        self._last_save = time.monotonic()
+        # Don't lose the last batch when the scan is interrupted
+        atexit.register(self.flush)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
 
     def _load_progress(self):
         if os.path.exists(self.progress_file):
             try:
-                with open(self.progress_file, 'r') as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
+                return read_json(self.progress_file)
+            except ValueError:
                 return {}
         return {}
 
     def save_progress(self):
         os.makedirs(os.path.dirname(self.progress_file), exist_ok=True)
-        with open(self.progress_file, 'w') as f:
-            json.dump(self.scanned_files, f, indent=2)
+        write_json(self.progress_file, self.scanned_files)
+        # Written second, so an error file newer than the progress file is known to be in sync
+        write_json(self.errors_file, self.failed_files)
+        self._dirty = 0
+        self._last_save = time.monotonic()
+
+    def flush(self):
+        """Save the progress if anything changed since the last save"""
+        if self._dirty:
+            self.save_progress()
 
-    def is_file_scanned(self, file_path):
-        return file_path in self.scanned_files
+    def is_file_scanned(self, file_path, file_stat=None):
+        """
+        Check whether a file was scanned before.
+        If a stat result is given, the file must also be unchanged since that scan.
+        """
+        entry = self.scanned_files.get(file_path)
+        if entry is None:
+            return False
+        # Entries written before size/mtime were tracked can't be compared
+        if file_stat is None or "size" not in entry:
+            return True
+        return entry["size"] == file_stat.st_size and entry["mtime_ns"] == file_stat.st_mtime_ns
 
-    def mark_file_scanned(self, file_path, status="ok"):
-        self.scanned_files[file_path] = {
+    def mark_file_scanned(self, file_path, status="ok", file_stat=None):
+        entry = {
             "last_scan": datetime.now().isoformat(),
             "status": status
         }
-        self.save_progress()
+        if file_stat is not None:
+            entry["size"] = file_stat.st_size
+            entry["mtime_ns"] = file_stat.st_mtime_ns
+        self.scanned_files[file_path] = entry
+        if status == "error":
+            self.failed_files[file_path] = entry
+        else:
+            self.failed_files.pop(file_path, None)
+        self._dirty += 1
+        if (self._dirty >= self.flush_every
+                or time.monotonic() - self._last_save >= FLUSH_INTERVAL):
+            self.save_progress()
@@ -1,42 +1,130 @@
 ﻿import os
+import errno
 import subprocess
 import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from file_cache import cache_key, load_cache_entries, preserve_timestamp, save_cache_entries
+
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+FFPROBE = shutil.which('ffprobe') or 'ffprobe'
+# Only log warnings and errors, the banner and progress stats would make up most of each log
+LOG_ARGS = ['-hide_banner', '-loglevel', 'warning']
+
+# Output directories that are known to exist, VOBs of the same folder share one
+_created_dirs = set()
+# Serializes picking a free name for fixed files and moving them there
+_move_lock = threading.Lock()
+
+# Error check results per file version (see file_cache.cache_key) -> has errors,
+# so unchanged VOBs aren't decoded again on the next run
+_error_cache = {}
+# Keeps the error check results of earlier runs
+ERROR_CACHE_FILE = "logs/repair_cache.json"
+
 
 def run_ffmpeg(cmd, log_file):
     try:
         with open(log_file, 'w') as log:
-            result = subprocess.run(cmd, stdout=log, stderr=log)
+            # ffmpeg would otherwise read the terminal for its keyboard commands,
+            # with several repairs running at once they'd compete for it
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=log)
         return result.returncode == 0
     except Exception as e:
         print(f"Error running command: {' '.join(cmd)}\n{e}")
         return False
 
 
-def has_ffmpeg_errors(file_path):
-    import subprocess
+def load_error_cache(cache_file=ERROR_CACHE_FILE):
+    """Load the error check results of earlier runs"""
+    for key, results in load_cache_entries(cache_file):
+        if 'has_errors' in results:
+            _error_cache[key] = results['has_errors']
+
+
+def save_error_cache(cache_file=ERROR_CACHE_FILE):
+    """Save the error check results of all files that still exist unchanged"""
+    save_cache_entries(cache_file, ((key, {'has_errors': has_errors})
+                                    for key, has_errors in _error_cache.items()))
+
+
+def has_ffmpeg_errors(file_path, file_stat=None):
+    """
+    Check a file for decode errors, reusing the result as long as the file is unchanged.
+    Callers that just stat'ed the file can pass the result along.
+    """
+    if file_stat is None:
+        file_stat = _stat(file_path)
+    if file_stat is None:
+        return _check_ffmpeg_errors(file_path)
+
+    key = cache_key(file_path, file_stat)
+    if key not in _error_cache:
+        _error_cache[key] = _check_ffmpeg_errors(file_path)
+    return _error_cache[key]
+
+
+def _check_ffmpeg_errors(file_path):
     cmd = [
-        'ffmpeg', '-v', 'error', '-i', str(file_path), '-f', 'null', '-'
+        FFMPEG, '-v', 'error', '-i', str(file_path), '-f', 'null', '-'
     ]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return bool(result.stderr.strip())
+    # Anything logged at the error level means the file is damaged,
+    # so decoding stops at the first line instead of running through the whole VOB
+    with subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE) as proc:
+        for line in proc.stderr:
+            if line.strip():
+                proc.terminate()
+                return True
+    return False
+
+
+def has_audio_stream(file_path):
+    """Check whether ffprobe finds an audio stream in the file"""
+    cmd = [
+        FFPROBE, '-v', 'error', '-select_streams', 'a:0',
+        '-show_entries', 'stream=index', '-of', 'csv=p=0', str(file_path)
+    ]
+    try:
+        result = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True)
+    except OSError as e:
+        print(f"Error running command: {' '.join(cmd)}\n{e}")
+        return False
+    return bool(result.stdout.strip())
+
+
+def _stat(file_path):
+    """Stat a file, returns None if it doesn't exist"""
+    try:
+        return os.stat(file_path)
+    except OSError:
+        return None
 
 
-def preserve_timestamp(source_file, target_file):
-    """Copy the timestamp from source file to target file"""
-    source_stat = os.stat(str(source_file))
-    os.utime(str(target_file), (source_stat.st_atime, source_stat.st_mtime))
+def output_base(vob_path):
+    """
+    Common path of all output files of a VOB, without any suffix.
+    The outputs are named with with_suffix(), so 'movie.part1.VOB' and
+    'movie.part2.VOB' both write to 'output/movie.*', just like 'movie.VOB' and 'movie.MPG'.
+    """
+    return (vob_path.parent / 'output' / vob_path.stem).with_suffix('')
 
 
 def process_vob(vob_path):
     vob_path = Path(vob_path)
     # Create output directory in the same folder as the VOB file
     output_dir = vob_path.parent / 'output'
-    output_dir.mkdir(parents=True, exist_ok=True)
-    base = output_dir / vob_path.stem
+    if output_dir not in _created_dirs:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(output_dir)
+    base = output_base(vob_path)
+    # Every output below copies the timestamp of the same source file
+    vob_stat = vob_path.stat()
 
-    if not has_ffmpeg_errors(vob_path):
+    if not has_ffmpeg_errors(vob_path, vob_stat):
         print(f"Original file {vob_path} has no errors. Nothing to do...")
         return None
 
@@ -48,19 +136,22 @@ def process_vob(vob_path):
         return None
 
     log1 = base.with_suffix('.remux.log')
-    if remuxed.exists():
-        remuxed.unlink()
+    remuxed.unlink(missing_ok=True)
     cmd1 = [
-        'ffmpeg', '-y', '-err_detect', 'ignore_err', '-i', str(vob_path),
+        FFMPEG, '-y', *LOG_ARGS, '-err_detect', 'ignore_err', '-i', str(vob_path),
         '-c', 'copy', str(remuxed)
     ]
     print(f"Remuxing {vob_path} ...")
-    if run_ffmpeg(cmd1, log1):
-        preserve_timestamp(vob_path, remuxed)
+    # Output of a run that ended with an error can still pass the check below,
+    # so it gets the timestamp as well, which a later rename then keeps
+    if run_ffmpeg(cmd1, log1) or remuxed.exists():
+        preserve_timestamp(vob_path, remuxed, vob_stat)
 
     # Step 2: Check for errors in remuxed file
-    if remuxed.exists() and remuxed.stat().st_size > 1 * 1024 * 1024:
-        if not has_ffmpeg_errors(remuxed):
+    # One stat answers whether the file exists, its size and its cache key
+    remuxed_stat = _stat(remuxed)
+    if remuxed_stat and remuxed_stat.st_size > 1 * 1024 * 1024:
+        if not has_ffmpeg_errors(remuxed, remuxed_stat):
             print(f"Remuxed file {remuxed} has no errors.")
             return remuxed
         else:
@@ -69,17 +160,17 @@ def process_vob(vob_path):
     # Step 3: Re-encode to MKV
     mkv = base.with_suffix('.mkv')
     log2 = base.with_suffix('.mkv.log')
-    if mkv.exists():
-        mkv.unlink()
+    mkv.unlink(missing_ok=True)
     cmd2 = [
-        'ffmpeg', '-y', '-err_detect', 'ignore_err', '-i', str(vob_path),
+        FFMPEG, '-y', *LOG_ARGS, '-err_detect', 'ignore_err', '-i', str(vob_path),
         '-c:v', 'libx264', '-c:a', 'aac', str(mkv)
     ]
-    if run_ffmpeg(cmd2, log2):
-        preserve_timestamp(vob_path, mkv)
+    if run_ffmpeg(cmd2, log2) or mkv.exists():
+        preserve_timestamp(vob_path, mkv, vob_stat)
 
-    if mkv.exists() and mkv.stat().st_size > 1 * 1024 * 1024:
-        if not has_ffmpeg_errors(mkv):
+    mkv_stat = _stat(mkv)
+    if mkv_stat and mkv_stat.st_size > 1 * 1024 * 1024:
+        if not has_ffmpeg_errors(mkv, mkv_stat):
             print(f"Re-encoded MKV {mkv} has no errors.")
             return mkv
         else:
@@ -88,52 +179,84 @@ def process_vob(vob_path):
     # Step 4: Extract streams as last resort
     m2v = base.with_suffix('.m2v')
     mp2 = base.with_suffix('.mp2')
-    log3v = base.with_suffix('.m2v.log')
-    log3a = base.with_suffix('.mp2.log')
-    cmd3v = [
-        'ffmpeg', '-y', '-err_detect', 'ignore_err', '-i', str(vob_path),
+    log3 = base.with_suffix('.extract.log')
+    # One ffmpeg writes both outputs, so the VOB is only read once.
+    # An output without any stream would fail the whole run,
+    # so VOBs without audio only get the m2v.
+    outputs = [m2v]
+    cmd3 = [
+        FFMPEG, '-y', *LOG_ARGS, '-err_detect', 'ignore_err', '-i', str(vob_path),
         '-map', '0:v:0', '-c', 'copy', str(m2v)
     ]
-    cmd3a = [
-        'ffmpeg', '-y', '-err_detect', 'ignore_err', '-i', str(vob_path),
-        '-map', '0:a:0', '-c', 'copy', str(mp2)
-    ]
-    print(f"Extracting video stream from {vob_path} ...")
-    if run_ffmpeg(cmd3v, log3v):
-        preserve_timestamp(vob_path, m2v)
-    print(f"Extracting audio stream from {vob_path} ...")
-    if run_ffmpeg(cmd3a, log3a):
-        preserve_timestamp(vob_path, mp2)
-    print(f"Extracted streams: {m2v}, {mp2}")
+    if has_audio_stream(vob_path):
+        outputs.append(mp2)
+        cmd3 += ['-map', '0:a:0', '-c', 'copy', str(mp2)]
+    print(f"Extracting video and audio streams from {vob_path} ...")
+    if run_ffmpeg(cmd3, log3):
+        for extracted in outputs:
+            if extracted.exists():
+                preserve_timestamp(vob_path, extracted, vob_stat)
+    print(f"Extracted streams: {', '.join(map(str, outputs))}")
     return None
 
 
-def process_folder(root_dir):
-    root_dir = Path(root_dir)
-
-    extensions = ['*.VOB', '*.MPG']
-    files = [f for ext in extensions for f in root_dir.rglob(ext)]
-
-    # Process all video files in the directory and its subdirectories
-    for vob_file in files:
+def process_vobs(vob_files):
+    """
+    Process VOBs that share their output files one after another.
+    Each fixed file is moved away before the next VOB overwrites the outputs.
+    """
+    for vob_file in vob_files:
         print(f"\nProcessing: {vob_file}")
         fixed_file = process_vob(vob_file)
 
         # If we got a successfully fixed file, move it to the parent directory
         if fixed_file and fixed_file.exists():
-            parent_dir = vob_file.parent
-            new_name = parent_dir / f"{vob_file.stem}_fixed{fixed_file.suffix}"
+            # Several jobs can pick a free name in the same folder at once
+            with _move_lock:
+                move_fixed_file(vob_file, fixed_file)
+
 
-            # If a file with the same name exists in the parent directory, add a number
-            counter = 1
-            while new_name.exists():
-                new_name = parent_dir / f"{vob_file.stem}_fixed_{counter}{fixed_file.suffix}"
-                counter += 1
+def move_fixed_file(vob_file, fixed_file):
+    """Move a fixed file next to its VOB, under a name that isn't taken yet"""
+    parent_dir = vob_file.parent
+    new_name = parent_dir / f"{vob_file.stem}_fixed{fixed_file.suffix}"
 
-            print(f"Moving fixed file to: {new_name}")
-            shutil.move(str(fixed_file), str(new_name))
-            # Preserve the timestamp after moving the file
-            preserve_timestamp(vob_file, new_name)
+    # If a file with the same name exists in the parent directory, add a number
+    counter = 1
+    while new_name.exists():
+        new_name = parent_dir / f"{vob_file.stem}_fixed_{counter}{fixed_file.suffix}"
+        counter += 1
+
+    print(f"Moving fixed file to: {new_name}")
+    try:
+        # The output dir is inside the VOB's folder, so this is a plain rename
+        # that keeps the timestamp process_vob gave the file
+        os.rename(fixed_file, new_name)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # A mount point in between, copy2 keeps the timestamp as well
+        shutil.move(str(fixed_file), str(new_name))
+
+
+def process_folder(root_dir, jobs=None):
+    root_dir = Path(root_dir)
+
+    extensions = ['*.VOB', '*.MPG']
+    files = [f for ext in extensions for f in root_dir.rglob(ext)]
+
+    # Files that write to the same output files stay in one job
+    groups = defaultdict(list)
+    for vob_file in files:
+        groups[output_base(vob_file)].append(vob_file)
+
+    # Process all video files in the directory and its subdirectories, several at once.
+    # The re-encodes use several cores each, so only half as many jobs as cores are run by default.
+    jobs = jobs or max(1, (os.cpu_count() or 1) // 2)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_vobs, vob_files) for vob_files in groups.values()]
+        for future in as_completed(futures):
+            future.result()
 
 
 if __name__ == "__main__":
@@ -141,5 +264,14 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Batch repair VOB files using ffmpeg.")
     parser.add_argument("input_folder", help="Root folder to scan for VOB files")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of files to repair in parallel "
+                             "(default: half the number of CPU cores)")
     args = parser.parse_args()
-    process_folder(args.input_folder)
+
+    # VOBs that haven't changed since an earlier run are not checked again
+    load_error_cache()
+    try:
+        process_folder(args.input_folder, jobs=args.jobs)
+    finally:
+        save_error_cache()